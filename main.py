@@ -1,36 +1,209 @@
+import asyncio
+import logging
+import logging.handlers
 import os
-from fastapi import FastAPI, Request
-from fastapi.responses import PlainTextResponse
-from twilio.twiml.voice_response import VoiceResponse, Gather
-from twilio.rest import Client as TwilioClient
+import queue
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape as xml_escape
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import Response
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+from redis.exceptions import RedisError
 from dotenv import load_dotenv
 
 # Load environment variables (local dev; Render uses its own env)
 load_dotenv()
 
+# Log through a queue so stderr writes happen on a listener thread (started
+# in lifespan), never on the event loop
+logger = logging.getLogger("edge")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+# `python main.py` imports this module twice (__main__, then main via
+# uvicorn); attach the queue handler only once and share its queue
+if not logger.handlers:
+    logger.addHandler(logging.handlers.QueueHandler(queue.SimpleQueue()))
+log_queue = logger.handlers[0].queue
+
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_NUMBER = os.getenv("TWILIO_NUMBER")
 BOOKING_URL = os.getenv("BOOKING_URL")
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Optional host for pre-rendered Polly Matthew MP3s of the static prompts,
+# served as {STATIC_AUDIO_BASE_URL}/{key}.mp3 for every key in STATIC_PROMPTS.
+# When set, Twilio plays the cached audio instead of synthesizing the same
+# text on every call.
+STATIC_AUDIO_BASE_URL = (os.getenv("STATIC_AUDIO_BASE_URL") or "").rstrip("/")
+
+# Abandoned calls expire on their own after this many seconds
+CALL_STATE_TTL = 600
+
+# Connection pool size per worker for the Redis state store
+REDIS_MAX_CONNECTIONS = 50
+
+# Upper bounds on external I/O, well under Twilio's 15s webhook timeout
+# (after which Twilio retries the turn)
+REDIS_TIMEOUT = 1.0
+SMS_TIMEOUT = 5.0
+
+# Hard cap on in-memory call states; oldest are evicted first
+MAX_CALL_STATES = 10_000
+
+# Resolve once whether the booking SMS can be sent and pre-build its body
+SMS_ENABLED = bool(TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_NUMBER and BOOKING_URL)
+SMS_BODY_TEMPLATE = (
+    "Thanks for calling Grooming Company. "
+    "We noted: '{service}' for '{time_pref}'. "
+    "Use this link to complete your booking: {booking_url}"
+)
+
+if not SMS_ENABLED:
+    logger.warning(
+        "Booking SMS disabled: set TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, "
+        "TWILIO_NUMBER and BOOKING_URL to enable it"
+    )
+
+TWILIO_MESSAGES_URL = (
+    f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
+)
+
+# Pooled HTTP/2 client for Twilio REST, created on the first SMS send so
+# workers don't import httpx/h2 at boot. SMS sends post straight to the
+# Messages API so we skip the SDK's resource objects we never read.
+twilio_http = None
+
+
+def get_twilio_http():
+    global twilio_http
+    if twilio_http is None:
+        import httpx
+
+        twilio_http = httpx.AsyncClient(
+            auth=(TWILIO_ACCOUNT_SID or "", TWILIO_AUTH_TOKEN or ""),
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20),
+            timeout=SMS_TIMEOUT,
+        )
+    return twilio_http
+
+
+# Shared state store so any worker can serve any turn of a call.
+# Without REDIS_URL (local dev) we fall back to process memory.
+# A blocking pool makes turns beyond the connection cap wait for a free
+# socket instead of failing with MaxConnectionsError.
+redis_client = (
+    Redis.from_pool(
+        BlockingConnectionPool.from_url(
+            REDIS_URL,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_TIMEOUT,
+            decode_responses=True,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT,
+            # No hidden retries; a slow store fails the turn within budget
+            retry=Retry(NoBackoff(), 0),
+        )
+    )
+    if REDIS_URL
+    else None
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global twilio_http
+
+    # Records logged before startup are already queued and get written now
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    log_listener.start()
+
+    yield
+
+    # Close pooled connections, then flush any queued log records
+    if twilio_http is not None:
+        await twilio_http.aclose()
+        # Let the next SMS (e.g. after a restart) build a fresh client
+        twilio_http = None
+    if redis_client is not None:
+        await redis_client.aclose()
+    log_listener.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# State per call
+# Redis hash "call:{CallSid}" or in-memory TTL cache { CallSid: {...} }
+# {"step": int, "service": str, "name": str, "time_pref": str}
+call_state = TTLCache(maxsize=MAX_CALL_STATES, ttl=CALL_STATE_TTL)
+
+
+def new_state() -> dict:
+    return {
+        "step": 0,
+        "service": None,
+        "name": None,
+        "time_pref": None,
+    }
+
 
-twilio_client = TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+def state_key(call_sid: str) -> str:
+    return f"call:{call_sid}"
 
-app = FastAPI()
 
-# Simple in-memory state per call
-# { CallSid: {"step": int, "service": str, "name": str, "time_pref": str} }
-call_state = {}
+async def get_or_create_state(call_sid: str) -> dict:
+    if redis_client is None:
+        return call_state.setdefault(call_sid, new_state())
 
+    state = new_state()
+    state.update(await asyncio.wait_for(redis_client.hgetall(state_key(call_sid)), REDIS_TIMEOUT))
+    state["step"] = int(state["step"])
+    return state
 
-def get_or_create_state(call_sid: str) -> dict:
-    if call_sid not in call_state:
-        call_state[call_sid] = {
-            "step": 0,
-            "service": None,
-            "name": None,
-            "time_pref": None,
-        }
-    return call_state[call_sid]
+
+async def save_state(call_sid: str, state: dict) -> None:
+    if redis_client is None:
+        # Re-set to restart the TTL, matching the Redis EXPIRE below
+        call_state[call_sid] = state
+        return
+
+    # Redis can't store None; missing fields come back as defaults
+    mapping = {k: v for k, v in state.items() if v is not None}
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(state_key(call_sid), mapping=mapping)
+        pipe.expire(state_key(call_sid), CALL_STATE_TTL)
+        await asyncio.wait_for(pipe.execute(), REDIS_TIMEOUT)
+
+
+async def clear_state(call_sid: str) -> None:
+    if redis_client is None:
+        call_state.pop(call_sid, None)
+        return
+
+    await asyncio.wait_for(redis_client.delete(state_key(call_sid)), REDIS_TIMEOUT)
+
+
+async def send_sms(to: str, body: str) -> None:
+    try:
+        # httpx timeouts are per phase; cap the whole send as well
+        response = await asyncio.wait_for(
+            get_twilio_http().post(
+                TWILIO_MESSAGES_URL,
+                data={"To": to, "From": TWILIO_NUMBER, "Body": body},
+            ),
+            timeout=SMS_TIMEOUT,
+        )
+        response.raise_for_status()
+    except Exception:
+        logger.exception("SMS send failed")
 
 
 def get_speech(form: dict) -> str:
@@ -38,163 +211,301 @@ def get_speech(form: dict) -> str:
     return str(speech).strip()
 
 
-@app.get("/")
-async def health_check():
-    return {"status": "ok", "message": "Edge fast receptionist running."}
+def twiml(content) -> Response:
+    return Response(content=content, media_type="application/xml")
+
+
+# TwiML has no response-wide voice default, so every <Say> carries it
+VOICE = "Polly.Matthew"
+
+
+# Every fixed prompt, by key. With STATIC_AUDIO_BASE_URL set, each key must
+# be hosted as {key}.mp3, rendered from this text with Polly Matthew.
+STATIC_PROMPTS = {
+    "invalid_call": (
+        "Grooming Company. This is Edge, the shop's digital assistant. "
+        "Please call back from a valid number."
+    ),
+    "greeting": (
+        "Grooming Company. This is Edge, the shop's digital assistant. "
+        "What can I help you with today?"
+    ),
+    "service_ack": "Got you, I can help with that. What's your first name?",
+    "ask_name": "Please tell me your first name.",
+    "retry_name": "Sorry, I didn't catch your name. Please tell me your first name.",
+    "time_example": "You can say something like, tomorrow at 3 p.m., or Saturday morning.",
+    "retry_time_pref": (
+        "Sorry, I didn't catch that. What day and time works best for your appointment?"
+    ),
+    "no_input": "I'm sorry, I didn't catch that. Please call back when you're ready.",
+    "farewell": (
+        "Perfect. I’ve got that noted. "
+        "I just sent a booking link to your phone so you can pick your exact time and complete payment. "
+        "Thank you for calling Grooming Company. Goodbye."
+    ),
+    "error": "I'm sorry, something went wrong. Please call back and we’ll get you taken care of.",
+}
+
+
+def static_prompt(key: str) -> bytes:
+    if STATIC_AUDIO_BASE_URL:
+        return f"<Play>{xml_escape(STATIC_AUDIO_BASE_URL)}/{key}.mp3</Play>".encode()
+    return f'<Say voice="{VOICE}">{xml_escape(STATIC_PROMPTS[key])}</Say>'.encode()
+
+
+def gather_open(timeout: int) -> bytes:
+    return (
+        f'<Gather input="speech" action="/twilio/voice" method="POST" timeout="{timeout}">'
+    ).encode()
+
+
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8"?>'
+
+# Spoken only if the preceding <Gather> times out without speech
+NO_INPUT_FALLBACK = static_prompt("no_input")
+
+# These responses never vary per call, so compose them once at import
+INVALID_CALL_TWIML = b"".join(
+    (
+        XML_DECLARATION,
+        b"<Response>",
+        static_prompt("invalid_call"),
+        b"<Hangup/>",
+        b"</Response>",
+    )
+)
+
+GREETING_TWIML = b"".join(
+    (
+        XML_DECLARATION,
+        b"<Response>",
+        gather_open(3),
+        static_prompt("greeting"),
+        b"</Gather>",
+        NO_INPUT_FALLBACK,
+        b"</Response>",
+    )
+)
+
+ASK_NAME_TWIML = b"".join(
+    (
+        XML_DECLARATION,
+        b"<Response>",
+        static_prompt("service_ack"),
+        gather_open(3),
+        static_prompt("ask_name"),
+        b"</Gather>",
+        NO_INPUT_FALLBACK,
+        b"</Response>",
+    )
+)
+
+FAREWELL_TWIML = b"".join(
+    (
+        XML_DECLARATION,
+        b"<Response>",
+        static_prompt("farewell"),
+        b"<Hangup/>",
+        b"</Response>",
+    )
+)
+
+ERROR_TWIML = b"".join(
+    (
+        XML_DECLARATION,
+        b"<Response>",
+        static_prompt("error"),
+        b"<Hangup/>",
+        b"</Response>",
+    )
+)
+
+RETRY_NAME_TWIML = b"".join(
+    (
+        XML_DECLARATION,
+        b"<Response>",
+        gather_open(3),
+        static_prompt("retry_name"),
+        b"</Gather>",
+        NO_INPUT_FALLBACK,
+        b"</Response>",
+    )
+)
+
+RETRY_TIME_PREF_TWIML = b"".join(
+    (
+        XML_DECLARATION,
+        b"<Response>",
+        gather_open(4),
+        static_prompt("retry_time_pref"),
+        b"</Gather>",
+        NO_INPUT_FALLBACK,
+        b"</Response>",
+    )
+)
+
+# step -> reply when a turn arrives without speech (first touch or an
+# empty gather). Nothing is written to Redis for these turns; without
+# REDIS_URL the in-memory entry was already created by the state lookup.
+NO_SPEECH_TWIML = {
+    0: GREETING_TWIML,
+    1: RETRY_NAME_TWIML,
+    2: RETRY_TIME_PREF_TWIML,
+}
+
+# The step-1 reply only varies by name, so join pre-encoded TwiML around it
+# (one allocation, no buffer regrowth)
+NAME_ACK_PREFIX = XML_DECLARATION + f'<Response><Say voice="{VOICE}">Nice to meet you, '.encode()
+NAME_ACK_SUFFIX = b"".join(
+    (
+        b". What day and time works best for your appointment?</Say>",
+        gather_open(4),
+        static_prompt("time_example"),
+        b"</Gather>",
+        NO_INPUT_FALLBACK,
+        b"</Response>",
+    )
+)
 
 
-@app.post("/twilio/voice", response_class=PlainTextResponse)
-async def twilio_voice(request: Request):
-    """
-    Main Twilio webhook.
-    Step 0: Ask what they need.
-    Step 1: Ask for name.
-    Step 2: Ask for time preference and send SMS.
-    """
-    form = await request.form()
-    call_sid = form.get("CallSid")
-    from_number = form.get("From")
-    speech = get_speech(form)
+def render_name_ack(first_name: str) -> bytes:
+    return b"".join((NAME_ACK_PREFIX, xml_escape(first_name).encode(), NAME_ACK_SUFFIX))
 
-    resp = VoiceResponse()
 
-    # If we somehow don't have a CallSid, bail gracefully
-    if not call_sid:
-        resp.say(
-            "Grooming Company. This is Edge, the shop's digital assistant. "
-            "Please call back from a valid number.",
-            voice="Polly.Matthew",
-        )
-        resp.hangup()
-        return str(resp)
-
-    state = get_or_create_state(call_sid)
-    step = state["step"]
-
-    # FIRST TOUCH: no speech yet, step 0 — greet and ask what they need
-    if step == 0 and not speech:
-        gather = Gather(
-            input="speech",
-            action="/twilio/voice",
-            method="POST",
-            timeout=3,
-        )
-        gather.say(
-            "Grooming Company. This is Edge, the shop's digital assistant. "
-            "What can I help you with today?",
-            voice="Polly.Matthew",
-        )
-        resp.append(gather)
+async def end_call_with_error(call_sid: str) -> bytes:
+    # Something's off with this call's state
+    await clear_state(call_sid)
+    return ERROR_TWIML
 
-        resp.say(
-            "I'm sorry, I didn't catch that. Please call back when you're ready.",
-            voice="Polly.Matthew",
-        )
-        return str(resp)
 
-    # STEP 0: They just told us what they need (service description)
-    if step == 0 and speech:
-        state["service"] = speech
+async def handle_service(
+    call_sid: str, state: dict, speech: str, from_number: str, background_tasks: BackgroundTasks
+) -> bytes:
+    # They just told us what they need (service description)
+    state["service"] = speech
 
-        resp.say(
-            "Got you, I can help with that. What's your first name?",
-            voice="Polly.Matthew",
-        )
+    # Move to step 1 to collect name
+    state["step"] = 1
+    await save_state(call_sid, state)
 
-        # Move to step 1 to collect name
-        state["step"] = 1
+    return ASK_NAME_TWIML
 
-        gather = Gather(
-            input="speech",
-            action="/twilio/voice",
-            method="POST",
-            timeout=3,
-        )
-        gather.say(
-            "Please tell me your first name.",
-            voice="Polly.Matthew",
-        )
-        resp.append(gather)
 
-        resp.say(
-            "I'm sorry, I didn't catch that. Please call back when you're ready.",
-            voice="Polly.Matthew",
-        )
-        return str(resp)
+async def handle_name(
+    call_sid: str, state: dict, speech: str, from_number: str, background_tasks: BackgroundTasks
+) -> bytes:
+    # They just told us their name
+    state["name"] = speech
 
-    # STEP 1: They just told us their name
-    if step == 1 and speech:
-        state["name"] = speech
+    # Simple first-name extraction (take first word)
+    first_name = speech.partition(" ")[0] or "there"
 
-        # Simple first-name extraction (take first word)
-        first_name = speech.split()[0] if speech else "there"
+    # Move to step 2 to collect time preference
+    state["step"] = 2
+    await save_state(call_sid, state)
 
-        resp.say(
-            f"Nice to meet you, {first_name}. What day and time works best for your appointment?",
-            voice="Polly.Matthew",
-        )
+    return render_name_ack(first_name)
 
-        # Move to step 2 to collect time preference
-        state["step"] = 2
 
-        gather = Gather(
-            input="speech",
-            action="/twilio/voice",
-            method="POST",
-            timeout=4,
-        )
-        gather.say(
-            "You can say something like, tomorrow at 3 p.m., or Saturday morning.",
-            voice="Polly.Matthew",
-        )
-        resp.append(gather)
+async def handle_time_pref(
+    call_sid: str, state: dict, speech: str, from_number: str, background_tasks: BackgroundTasks
+) -> bytes:
+    # They just told us their time preference
+    state["time_pref"] = speech
 
-        resp.say(
-            "I'm sorry, I didn't catch that. Please call back when you're ready.",
-            voice="Polly.Matthew",
-        )
-        return str(resp)
-
-    # STEP 2: They just told us their time preference
-    if step == 2 and speech:
-        state["time_pref"] = speech
-
-        # Try to send an SMS with booking link
-        if from_number and TWILIO_NUMBER and BOOKING_URL:
-            try:
-                body = (
-                    "Thanks for calling Grooming Company. "
-                    f"We noted: '{state['service']}' for '{state['time_pref']}'. "
-                    f"Use this link to complete your booking: {BOOKING_URL}"
-                )
-                twilio_client.messages.create(
-                    body=body,
-                    from_=TWILIO_NUMBER,
-                    to=from_number,
-                )
-            except Exception as e:
-                print("SMS send error:", e)
-
-        resp.say(
-            "Perfect. I’ve got that noted. "
-            "I just sent a booking link to your phone so you can pick your exact time and complete payment. "
-            "Thank you for calling Grooming Company. Goodbye.",
-            voice="Polly.Matthew",
+    # Try to send an SMS with booking link
+    if from_number and SMS_ENABLED:
+        body = SMS_BODY_TEMPLATE.format(
+            service=state["service"],
+            time_pref=state["time_pref"],
+            booking_url=BOOKING_URL,
         )
-        resp.hangup()
+        # Sent after the TwiML response has been flushed to Twilio
+        background_tasks.add_task(send_sms, from_number, body)
 
-        # Clean up this call's state
-        call_state.pop(call_sid, None)
-        return str(resp)
+    # Clean up this call's state. The SMS is already queued, so a failed
+    # cleanup must not turn this into an error; the TTL removes the key.
+    try:
+        await clear_state(call_sid)
+    except (RedisError, asyncio.TimeoutError):
+        logger.exception("Call state cleanup failed")
+    return FAREWELL_TWIML
 
-    # If we reach here, something's off or they were silent at a later step
-    resp.say(
-        "I'm sorry, something went wrong. Please call back and we’ll get you taken care of.",
-        voice="Polly.Matthew",
-    )
-    resp.hangup()
-    call_state.pop(call_sid, None)
-    return str(resp)
+
+# step -> handler for the caller's answer at that step
+STEP_HANDLERS = {
+    0: handle_service,
+    1: handle_name,
+    2: handle_time_pref,
+}
 
 
+# Hit constantly by load balancers; the body never changes, so skip JSON
+# serialization entirely
+HEALTH_CHECK_JSON = b'{"status":"ok","message":"Edge fast receptionist running."}'
 
+
+@app.get("/")
+async def health_check():
+    return Response(content=HEALTH_CHECK_JSON, media_type="application/json")
+
+
+@app.post("/twilio/voice")
+async def twilio_voice(request: Request, background_tasks: BackgroundTasks):
+    """
+    Main Twilio webhook.
+    Step 0: Ask what they need.
+    Step 1: Ask for name.
+    Step 2: Ask for time preference and send SMS.
+    """
+    # Twilio posts small urlencoded bodies; parse them directly rather than
+    # through Starlette's FormData
+    form = dict(parse_qsl((await request.body()).decode(), keep_blank_values=True))
+    call_sid = form.get("CallSid")
+    from_number = form.get("From")
+    speech = get_speech(form)
+
+    # If we somehow don't have a CallSid, bail gracefully
+    if not call_sid:
+        return twiml(INVALID_CALL_TWIML)
+
+    try:
+        state = await get_or_create_state(call_sid)
+
+        step = state["step"]
+        handler = STEP_HANDLERS.get(step)
+        if handler is None:
+            return twiml(await end_call_with_error(call_sid))
+
+        # FIRST TOUCH or an empty gather: (re-)ask this step's question
+        if not speech:
+            return twiml(NO_SPEECH_TWIML[step])
+
+        return twiml(await handler(call_sid, state, speech, from_number, background_tasks))
+    except (RedisError, asyncio.TimeoutError):
+        # State store is down or too slow; answer now rather than letting
+        # Twilio time out and retry the turn
+        logger.exception("Call state store failed")
+        return twiml(ERROR_TWIML)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # In-memory call state lives in one process, so later turns of a call
+    # would miss it on another worker; only fan out when Redis is shared
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if redis_client is None and workers > 1:
+        logger.warning("REDIS_URL not set; running 1 worker instead of %d", workers)
+        workers = 1
+
+    # loop/http "auto" pick uvloop and httptools when installed (uvicorn[standard]
+    # on Linux/macOS) and fall back to asyncio/h11 elsewhere, e.g. Windows
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="auto",
+        workers=workers,
+    )